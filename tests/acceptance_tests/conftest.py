@@ -0,0 +1,4 @@
+# The acceptance tests run the whole procedure, so they need
+# the mocks of both the server and the camera tests
+from tests.mocks.server import overlay_png_bytes, mock_ftplib, mock_requests
+from tests.mocks.camera import mock_piexif
@@ -1,7 +1,6 @@
-from typing import Union
+from typing import Any, List, Tuple, Union
 
 import os
-import json
 import time
 import pytest
 import logging
@@ -10,7 +9,7 @@ from PIL import Image
 from textwrap import dedent
 from fractions import Fraction
 from collections import namedtuple
-from collections import defaultdict
+from collections import deque
 from pathlib import Path, PosixPath
 from inspect import getmembers, isfunction, isclass, ismethod
 
@@ -18,6 +17,84 @@ from zanzocam import constants
 from zanzocam.webcam import main, system, server, camera, overlays, configuration, utils
 from zanzocam.webcam.utils import log
 
+from tests.mocks.utils import json_loads, json_dumps
+
+
+#: Modules holding their own copy of the constants
+_PATCHED_MODULES = [
+    main,
+    system,
+    server.server,
+    server.http_server,
+    server.ftp_server,
+    camera,
+    overlays,
+    configuration
+]
+
+#: Path of the package, to be replaced by the temp directory
+_BASE_PATH = str(constants.BASE_PATH.absolute()).strip()
+
+
+def _split_path(value: Union[Path, str]) -> Tuple[List[str], bool]:
+    """
+        Splits a value around the package path, so that it can be
+        rebuilt for each temp directory with a single join.
+    """
+    return str(value).split(_BASE_PATH), isinstance(value, PosixPath)
+
+
+def _rebuild_path(split_value: Tuple[List[str], bool], test_path: str) -> Union[Path, str]:
+    parts, is_path = split_value
+    new_value = test_path.join(parts)
+    if is_path:
+        new_value = Path(new_value)
+    return new_value
+
+
+def _points_to_package(value: Any) -> bool:
+    return isinstance(value, (Path, str)) and _BASE_PATH in str(value)
+
+
+#: All the constants pointing into the package, split around its path
+_PATH_CONSTANTS = {
+    const: _split_path(value) for const, value in vars(constants).items()
+    if not const.startswith("_") and _points_to_package(value)
+}
+
+#: For each module, the constants it actually imported
+_MODULE_CONSTANTS = [
+    (module, [const for const in _PATH_CONSTANTS if const in vars(module)])
+    for module in _PATCHED_MODULES
+]
+
+
+def _functions_with_path_defaults():
+    """
+        Gathers all the functions of the patched modules that have
+        a default value pointing into the package, along with their
+        defaults (split if needed).
+    """
+    functions = {}
+    for module in _PATCHED_MODULES:
+        for name, func in getmembers(module, isfunction):
+            functions[id(func)] = func
+        for name, clas in getmembers(module, isclass):
+            for name, func in getmembers(clas, ismethod):
+                functions[id(func)] = func
+
+    return [
+        (function, [
+            (_split_path(value) if _points_to_package(value) else None, value)
+            for value in function.__defaults__
+        ])
+        for function in functions.values()
+        if function.__defaults__ and any(
+            _points_to_package(value) for value in function.__defaults__)
+    ]
+
+_PATH_DEFAULTS_FUNCTIONS = _functions_with_path_defaults()
+
 
 @pytest.fixture(autouse=True)
 def point_to_tmpdir(monkeypatch, tmpdir):
@@ -25,64 +102,34 @@ def point_to_tmpdir(monkeypatch, tmpdir):
         Mocks all the calues in constants.py to point to the 
         pytest temp directory.
     """
-    modules = [
-        main,
-        system,
-        server.server,
-        server.http_server,
-        server.ftp_server,
-        camera,
-        overlays,
-        configuration
-    ]
     os.mkdir(tmpdir / "data")
     os.mkdir(tmpdir / "web_ui")
     os.mkdir(tmpdir / "data" / "overlays")
 
-    base_path = str(constants.BASE_PATH.absolute()).strip()
     test_path = str(tmpdir).strip()
 
-    for const, value in vars(constants).items():
-        if (not const.startswith("_") and
-            (isinstance(value, str) or 
-            isinstance(value, PosixPath)
-        )):
-            # Patch value of constant
-            new_value = _patch_path(value, base_path, test_path)
-
-            # Patch actual constants
-            monkeypatch.setattr(constants, const, new_value)
-            for module in modules:
-                try:
-                    monkeypatch.setattr(module, const, new_value)
-                except Exception as e:
-                    pass
-                    
-                # Gaher all function signatures for each module
-                functions = [func for name, func in getmembers(module, isfunction)]
-                for clas in getmembers(module, isclass):
-                    functions += [func for name, func in getmembers(clas, ismethod)]
-
-                # Mock function defaults
-                for function in functions:
-                    new_defaults = []
-                    if function.__defaults__:
-                        for value in function.__defaults__:
-                            if isinstance(value, Path) or isinstance(value, str):
-                                value = _patch_path(value, base_path, test_path)
-                            new_defaults.append(value)
-                        monkeypatch.setattr(function, "__defaults__", tuple(new_defaults))
+    # Patch actual constants
+    new_values = {}
+    for const, split_value in _PATH_CONSTANTS.items():
+        new_values[const] = _rebuild_path(split_value, test_path)
+        monkeypatch.setattr(constants, const, new_values[const])
+
+    # Patch the copies imported by the modules
+    for module, module_constants in _MODULE_CONSTANTS:
+        for const in module_constants:
+            monkeypatch.setattr(module, const, new_values[const])
+
+    # Mock function defaults
+    for function, defaults in _PATH_DEFAULTS_FUNCTIONS:
+        new_defaults = tuple(
+            _rebuild_path(split_value, test_path) if split_value else value
+            for split_value, value in defaults
+        )
+        monkeypatch.setattr(function, "__defaults__", new_defaults)
 
     monkeypatch.setattr(system, "CRONJOB_FILE", tmpdir / "zanzocam")
 
 
-def _patch_path(value: Union[Path, str], base_path: str, test_path: str) -> Union[Path, str]:
-    new_value = str(value).replace(base_path, test_path)
-    if isinstance(value, PosixPath):
-        new_value = Path(new_value)
-    return new_value
-
-
 @pytest.fixture()
 def mock_modules_apart_config(monkeypatch):
     """
@@ -185,148 +232,32 @@ def load_mock_config():
     return MockConfig()
 
 
+def _noop(*a, **k):
+    return None
+
+
 class MockConfig:
     def __init__(self, *a, **k):
         log("[TEST] init Config - mocked")
 
     def __getattr__(self, *a, **k):
-        return lambda *a, **k: None
+        return _noop
 
     def within_active_hours(self):
         return True
     
     def __str__(self):
-        return json.dumps(vars(self), indent=4, default=lambda x: str(x))
-
-
-class MockFTP:
-    def __init__(self, *a, **k):
-        pass
-    def prot_p(self, *a, **k):
-        pass
-    def cwd(self, folder, **k):
-        pass
-    def retrbinary(self, bin_to_download, callback, **k):
-
-        # If you're asking for the config file, download it
-        if str(constants.CONFIGURATION_FILE.name) in bin_to_download:
-            for line in open(constants.CONFIGURATION_FILE, 'r').readlines():
-                callback(line.encode(constants.FTP_CONFIG_FILE_ENCODING))
-            return "226 OK"
-
-        # Else, download an overlay
-        else:
-            image = Image.new("RGB", (10, 10), color="#FFFFFF")
-            image.save(str(constants.BASE_PATH /'test.png'))
-            with open(constants.BASE_PATH /'test.png', 'rb') as o:
-                callback(o.read())
-            return "226 OK"
-
-    def storlines(self, command, lines, **k):
-        with open(constants.BASE_PATH / "test_received_logs.txt", 'wb') as r:
-            r.writelines(lines)
-        return "226 OK"
-
-    def storbinary(self, command, file_handle, **k):
-        name = command[14:]
-        with open(constants.BASE_PATH / ("r_"+name), 'wb') as r:
-            r.write(file_handle.read())
-        return "226 OK"
-
-    def rename(self, old, new, **k):
-        return "226 OK"
-
-
-@pytest.fixture(autouse=True)
-def mock_ftplib(monkeypatch, point_to_tmpdir):
-    try:
-        monkeypatch.setattr(server.ftp_server, "FTP", MockFTP)
-        monkeypatch.setattr(server.ftp_server, "FTP_TLS", MockFTP)
-        monkeypatch.setattr(server.ftp_server, "_Patched_FTP_TLS", MockFTP)
-    except Exception:
-        print(f"Failed to apply ftplib monkeypatch")
-
-
-class MockCredentials:
-    def __init__(self, u, p):
-        pass
-
-class MockGetRequest:
-
-    def __init__(self, data=None, status=200, file_stream=None):
-        self.data = data
-        self.raw = file_stream
-        self.status_code = status
-        self.reason = "TEST REASON"
-
-    def json(self):
-        if self.data:
-            return json.loads(self.data)
-        return {}
-
-class MockPostRequest:
-
-    def __init__(self, data=None, image=None, response=None, status=200, tmpdir=None):
-        if data:
-            utils.log(f"[TEST] POSTing: {data}")
-
-        if image and tmpdir:
-            utils.log(f"[TEST] POSTing an image")
-            with open(tmpdir / "received_image.jpg", "wb") as received:
-                received.write(image['photo'].read())
-
-        if response:
-            self.data = response
-        else:
-            self.data = json.dumps({
-                "logs": "",
-                "photo": "",
-            })
-        self.status_code = status
-        self.reason = "TEST REASON"
-
-    def json(self):
-        if self.data:
-            return json.loads(self.data)
-        return {}
-
-
-@pytest.fixture(autouse=True)
-def mock_requests(monkeypatch, point_to_tmpdir):
-    
-    def default_get_behavior(url, auth=None, timeout=None, *a, **k):
-        
-        # If you're asking for the config file, download it
-        if not any(ext in url.lower() for ext in ['.jpeg', '.png', '.gif']):
-            return MockGetRequest(data=
-                '{"configuration": \n' +
-                open(constants.CONFIGURATION_FILE, 'r').read() +
-                '\n}')
-        
-        # Else, download an overlay
-        else:
-            image = Image.new("RGB", (10, 10), color="#FFFFFF")
-            image.save(str(constants.BASE_PATH /'test.png'))
-            return MockGetRequest(file_stream=open(constants.BASE_PATH/'test.png', 'rb'))
-    
-    try:
-        monkeypatch.setattr(server.http_server.requests.auth,
-                            'HTTPBasicAuth',
-                            lambda u, p: MockCredentials(u, p))
-
-        monkeypatch.setattr(server.http_server.requests, 
-                            'get', default_get_behavior)
-
-        monkeypatch.setattr(server.http_server.requests,
-                            'post', lambda *a, **k: MockPostRequest())
-    except Exception:
-        print(f"Failed to apply requests monkeypatch")
+        return json_dumps(vars(self), indent=True)
 
 
 MockResolution = namedtuple('PiResolution', 'width height')
 MockFramerateRange = namedtuple('PiFramerateRange', 'low high')
 
 
+class MockPiCameraMMALError(Exception):
+    pass
+
+
 class MockPiCamera:
     def __init__(self, sensor_mode=None, framerate_range=None, *a, **k):
         self.sensor_mode = sensor_mode
@@ -347,52 +278,18 @@ class MockPiCamera:
     def __getattr__(self, *a, **k):
         return
 
-    def capture(self, path, *a, **k):
-        Image.new("RGB", (64, 48), color="#FF0000").save(path)
-
-
-@pytest.fixture(autouse=True)
-def mock_piexif(monkeypatch, point_to_tmpdir):
-    """
-        Used in the tests of camera.py to mock away PIEXIF
-        Note: PIEXIF can be mocked, but the data need to be
-        there somehow, so the workaround is copying it from
-        a real picture, exif-source.jpg
-    """
-    original_image_save = camera.Image.Image.save
-
-    def altered_image_save(self, *a, **k):
-        if "exif" in k.keys():
-            original_image_save(self, *a, **k)
+    def capture(self, output, format=None, resize=None, *a, **k):
+        if format == "rgb":
+            frame = Image.new("RGB", resize or (64, 48), color="#FF0000").tobytes()
+            if hasattr(output, "write"):
+                output.write(frame)
+            else:
+                memoryview(output)[:] = frame
             return
-        photo = Image.open(str(Path(__file__).parent / "exif-source.jpg"))
-        exif = photo.info["exif"]
-        original_image_save(self, *a, **k, exif=exif)
-
-    monkeypatch.setattr(
-        camera.Image.Image,
-        "save",
-        altered_image_save
-    )
-
-    monkeypatch.setattr(
-        camera.piexif,
-        'load',
-        lambda *a, **k: defaultdict(lambda: defaultdict(lambda: ""))
-    )
-    monkeypatch.setattr(
-        camera.piexif,
-        'dump',
-        lambda *a, **k: None
-    )
-    monkeypatch.setattr(camera.piexif.ImageIFD, 'Make', None)
-    monkeypatch.setattr(camera.piexif.ImageIFD, 'Software', None)
-    monkeypatch.setattr(camera.piexif.ImageIFD, 'ProcessingSoftware', None)
+        Image.new("RGB", (64, 48), color="#FF0000").save(output)
 
 
-@pytest.fixture
-def meminfo():
-    yield dedent("""\n
+_MEMINFO = dedent("""\n
         MemTotal:         245724 kB
         MemFree:          146968 kB
         MemAvailable:     160988 kB
@@ -434,28 +331,51 @@ def meminfo():
     """)
 
 
+@pytest.fixture
+def meminfo():
+    yield _MEMINFO
+
+
+class Logs(deque):
+    """
+        The stack of captured log messages. Keeps the joined
+        text around until new messages are appended.
+    """
+    _joined = ""
+    _joined_length = 0
+
+    def joined(self) -> str:
+        if self._joined_length != len(self):
+            self._joined = "\n".join(self)
+            self._joined_length = len(self)
+        return self._joined
+
+
 @pytest.fixture
 def logs(monkeypatch):
-    logs = []
+    logs = Logs()
 
     def mock_log(msg, *args, **kwargs):
-        print(msg)
         logs.append(msg)
     
+    # log() skips the messages if the root logger is not set to INFO
+    root_level = logging.root.level
+    logging.root.setLevel(logging.INFO)
+
     logging.info = mock_log
     yield logs
     logs = []
+    logging.root.setLevel(root_level)
 
 
 def in_logs(logs, string):
     """
         Looks for a string in the entire logs stack
     """
-    total = "\n".join(logs)
-    try:
-        where = total.index(string) + 1  # So that 0 == not found
-        print(f"---------> {string}: {where}")
-        return True
-    except ValueError:
-        return False
-
+    # Tests import this module as `tests.conftest`, while pytest loads it 
+    # as `conftest`: check for the method rather than for the class
+    total = logs.joined() if hasattr(logs, "joined") else "\n".join(logs)
+    where = total.find(string)
+    if where >= 0:
+        print(f"---------> {string}: {where + 1}")
+    return where >= 0
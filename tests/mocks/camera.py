@@ -0,0 +1,51 @@
+# Fixtures for the tests that shoot pictures. Conftests import them:
+# the patches are module-scoped, so they're undone when leaving the folder
+
+import pytest
+
+from PIL import Image
+from pathlib import Path
+from collections import defaultdict
+
+from zanzocam.webcam import camera
+
+
+@pytest.fixture(autouse=True, scope="module")
+def mock_piexif():
+    """
+        Used in the tests of camera.py to mock away PIEXIF
+        Note: PIEXIF can be mocked, but the data need to be
+        there somehow, so the workaround is copying it from
+        a real picture, exif-source.jpg
+    """
+    original_image_save = camera.Image.Image.save
+
+    def altered_image_save(self, *a, **k):
+        if "exif" in k.keys():
+            original_image_save(self, *a, **k)
+            return
+        photo = Image.open(str(Path(__file__).parents[1] / "exif-source.jpg"))
+        exif = photo.info["exif"]
+        original_image_save(self, *a, **k, exif=exif)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(
+            camera.Image.Image,
+            "save",
+            altered_image_save
+        )
+
+        monkeypatch.setattr(
+            camera.piexif,
+            'load',
+            lambda *a, **k: defaultdict(lambda: defaultdict(lambda: ""))
+        )
+        monkeypatch.setattr(
+            camera.piexif,
+            'dump',
+            lambda *a, **k: None
+        )
+        monkeypatch.setattr(camera.piexif.ImageIFD, 'Make', None)
+        monkeypatch.setattr(camera.piexif.ImageIFD, 'Software', None)
+        monkeypatch.setattr(camera.piexif.ImageIFD, 'ProcessingSoftware', None)
+        yield
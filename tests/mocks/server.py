@@ -0,0 +1,178 @@
+# Fixtures for the tests that talk to the server. Conftests import them:
+# the patches are module-scoped, so they're undone when leaving the folder
+
+import io
+import os
+import re
+import pytest
+
+from PIL import Image
+from functools import lru_cache
+from pathlib import Path
+
+from zanzocam import constants
+from zanzocam.webcam import server, utils
+
+from tests.mocks.utils import json_loads, json_dumps
+
+
+@lru_cache(maxsize=4)
+def _cached_config_bytes(path: str, mtime: int, encoding: str):
+    """
+        Reads the configuration file once per modification time
+        and returns it already encoded.
+    """
+    return Path(path).read_text().encode(encoding)
+
+
+@lru_cache(maxsize=4)
+def _cached_config_body(path: str, mtime: int):
+    """
+        Reads the configuration file once per modification time
+        and wraps it as the server would send it.
+    """
+    return '{"configuration": \n' + Path(path).read_text() + '\n}'
+
+
+def _config_mtime() -> int:
+    return os.stat(constants.CONFIGURATION_FILE).st_mtime_ns
+
+
+@pytest.fixture(scope="session")
+def overlay_png_bytes():
+    """
+        A small white PNG, encoded once per session and
+        served by the mocks whenever an overlay is downloaded.
+    """
+    buffer = io.BytesIO()
+    Image.new("RGB", (10, 10), color="#FFFFFF").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class MockFTP:
+    overlay_bytes = b""
+
+    def __init__(self, *a, **k):
+        pass
+    def prot_p(self, *a, **k):
+        pass
+    def cwd(self, folder, **k):
+        pass
+    def retrbinary(self, bin_to_download, callback, **k):
+
+        # If you're asking for the config file, download it
+        if str(constants.CONFIGURATION_FILE.name) in bin_to_download:
+            callback(_cached_config_bytes(str(constants.CONFIGURATION_FILE),
+                                          _config_mtime(),
+                                          constants.FTP_CONFIG_FILE_ENCODING))
+            return "226 OK"
+
+        # Else, download an overlay
+        else:
+            callback(self.overlay_bytes)
+            return "226 OK"
+
+    def storlines(self, command, lines, **k):
+        with open(constants.BASE_PATH / "test_received_logs.txt", 'wb') as r:
+            r.writelines(lines)
+        return "226 OK"
+
+    def storbinary(self, command, file_handle, **k):
+        name = command[14:]
+        with open(constants.BASE_PATH / ("r_"+name), 'wb') as r:
+            r.write(file_handle.read())
+        return "226 OK"
+
+    def rename(self, old, new, **k):
+        return "226 OK"
+
+
+@pytest.fixture(autouse=True, scope="module")
+def mock_ftplib(overlay_png_bytes):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        try:
+            monkeypatch.setattr(MockFTP, "overlay_bytes", overlay_png_bytes)
+            monkeypatch.setattr(server.ftp_server, "FTP", MockFTP)
+            monkeypatch.setattr(server.ftp_server, "FTP_TLS", MockFTP)
+            monkeypatch.setattr(server.ftp_server, "_Patched_FTP_TLS", MockFTP)
+        except Exception:
+            print(f"Failed to apply ftplib monkeypatch")
+        yield
+
+
+class MockCredentials:
+    def __init__(self, u, p):
+        pass
+
+class MockGetRequest:
+
+    def __init__(self, data=None, status=200, file_stream=None):
+        self.data = data
+        self.raw = file_stream
+        self.status_code = status
+        self.reason = "TEST REASON"
+
+    def json(self):
+        if self.data:
+            return json_loads(self.data)
+        return {}
+
+class MockPostRequest:
+
+    def __init__(self, data=None, image=None, response=None, status=200, tmpdir=None):
+        if data:
+            utils.log(f"[TEST] POSTing: {data}")
+
+        if image and tmpdir:
+            utils.log(f"[TEST] POSTing an image")
+            with open(tmpdir / "received_image.jpg", "wb") as received:
+                received.write(image['photo'].read())
+
+        if response:
+            self.data = response
+        else:
+            self.data = json_dumps({
+                "logs": "",
+                "photo": "",
+            })
+        self.status_code = status
+        self.reason = "TEST REASON"
+
+    def json(self):
+        if self.data:
+            return json_loads(self.data)
+        return {}
+
+
+#: Matches the URLs of the overlay images
+_OVERLAY_URL = re.compile(r"\.(?:jpeg|png|gif)", re.IGNORECASE)
+
+
+@pytest.fixture(autouse=True, scope="module")
+def mock_requests(overlay_png_bytes):
+
+    def default_get_behavior(url, auth=None, timeout=None, *a, **k):
+
+        # If you're asking for the config file, download it
+        if not _OVERLAY_URL.search(url):
+            return MockGetRequest(data=_cached_config_body(
+                str(constants.CONFIGURATION_FILE), _config_mtime()))
+
+        # Else, download an overlay
+        else:
+            return MockGetRequest(file_stream=io.BytesIO(overlay_png_bytes))
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        try:
+            monkeypatch.setattr(server.http_server.requests.auth,
+                                'HTTPBasicAuth',
+                                lambda u, p: MockCredentials(u, p))
+
+            monkeypatch.setattr(server.http_server.requests,
+                                'get', default_get_behavior)
+
+            monkeypatch.setattr(server.http_server.requests,
+                                'post', lambda *a, **k: MockPostRequest())
+        except Exception:
+            print(f"Failed to apply requests monkeypatch")
+        yield
@@ -0,0 +1,29 @@
+from typing import Any, Union
+
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional: the standard json module is used instead
+    orjson = None
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """
+        Parses JSON with orjson if available. orjson's decoding error
+        subclasses json.JSONDecodeError, so it's caught the same way.
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data: Any, indent: bool = False) -> str:
+    """
+        Serializes to JSON with orjson if available, converting
+        unknown types to strings. orjson only indents by 2 spaces.
+    """
+    if orjson:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(data, option=option, default=str).decode()
+    return json.dumps(data, indent=2 if indent else None, default=str)
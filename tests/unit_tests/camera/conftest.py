@@ -0,0 +1 @@
+from tests.mocks.camera import mock_piexif
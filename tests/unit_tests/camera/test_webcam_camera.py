@@ -15,7 +15,7 @@ except ImportError as e:
     from tests.conftest import MockPiCamera as PiCamera
     webcam.camera.PiCamera = PiCamera
 
-from conftest import in_logs
+from tests.conftest import in_logs
 
 
 def test_create_camera_no_dict(monkeypatch, logs):
@@ -131,6 +131,18 @@ def test_take_picture(monkeypatch, logs):
     assert "Processing picture" in logs[1]
 
 
+def test_measure_luminance(tmpdir, logs):
+    camera = Camera({'image': {}})
+    camera.temp_photo_path = tmpdir / "temp_photo.jpg"
+    width, height = constants.LUMINANCE_PROBE_RESOLUTION
+    frame_buffer = bytearray(width * height * 3)
+    with camera._prepare_camera_object() as picam:
+        assert camera._measure_luminance(picam, frame_buffer) > constants.MINIMUM_DAYLIGHT_LUMINANCE
+        assert frame_buffer[:3] == b"\xff\x00\x00"
+        assert len(logs) == 0
+        assert not os.path.exists(tmpdir / "temp_photo.jpg")
+
+
 def test_shoot_picture_no_low_light_check(tmpdir, logs):
     camera = Camera({'image': {}})
     camera.temp_photo_path = tmpdir / "temp_photo.jpg"
@@ -185,11 +197,10 @@ def test_shoot_picture_low_light_luminance_no_settle(monkeypatch, tmpdir, logs):
                         lambda *a, **k: (constants.MINIMUM_DAYLIGHT_LUMINANCE, 1, 1, 1))
 
     camera._shoot_picture()
-    assert len(logs) == 4
+    assert len(logs) == 3
     assert "Camera warm-up" in logs[0]
     assert "Taking picture" in logs[1]
     assert "Picture taken" in logs[2]
-    assert "AWB adjusted picture not required" in logs[3]
 
 
 def test_shoot_picture_low_light_luminance_with_settle(monkeypatch, tmpdir, logs):
@@ -204,15 +215,11 @@ def test_shoot_picture_low_light_luminance_with_settle(monkeypatch, tmpdir, logs
                         lambda *a, **k: (constants.MINIMUM_DAYLIGHT_LUMINANCE, 1, 1, 1))
 
     camera._shoot_picture()
-    assert len(logs) == 8
+    assert len(logs) == 4
     assert "Camera warm-up" in logs[0]
     assert "Taking picture" in logs[1]
     assert "Picture taken" in logs[2]
-    assert "Taking AWB stabilized picture with the final parameters" in logs[3]
-    assert "Adjusting white balance" in logs[4]
-    assert "Taking picture" in logs[5]
-    assert "Picture taken" in logs[6]
-    assert "Final luminance" in logs[7]
+    assert "Final luminance" in logs[3]
 
 
 def test_low_light_search_twilight_three_attempts(monkeypatch, tmpdir, logs):
@@ -224,7 +231,7 @@ def test_low_light_search_twilight_three_attempts(monkeypatch, tmpdir, logs):
                         lambda *a, **k: None)
 
     monkeypatch.setattr(webcam.camera.Camera, 
-                        '_luminance_from_path', 
+                        '_measure_luminance', 
                         mock.Mock(side_effect=[
                             constants.MINIMUM_DAYLIGHT_LUMINANCE + 10,
                             constants.MINIMUM_DAYLIGHT_LUMINANCE - 10,
@@ -242,6 +249,40 @@ def test_low_light_search_twilight_three_attempts(monkeypatch, tmpdir, logs):
     assert "bright. Luminance achieved" in logs[3]
     assert "dark. Luminance achieved" in logs[4]
     assert "OK! Luminance achieved" in logs[5]
+    min_shutter_speed = f"shutter speed: {constants.MIN_SHUTTER_SPEED/10**6:.2f}s"
+    assert min_shutter_speed in logs[3]
+    assert f"ISO: {constants.INITIAL_LOW_LIGHT_ISO}" in logs[3]
+
+
+def test_low_light_search_lets_awb_settle_on_the_same_camera(monkeypatch, tmpdir, logs):
+    camera = Camera({'image': {'let_awb_settle_in_dark': True}})
+    camera.temp_photo_path = tmpdir / "temp_photo.jpg"
+
+    monkeypatch.setattr(webcam.camera,
+                        "sleep",
+                        lambda *a, **k: None)
+    monkeypatch.setattr(webcam.camera.Camera,
+                        "_prepare_camera_object",
+                        mock.Mock(return_value=PiCamera()))
+    monkeypatch.setattr(webcam.camera.Camera, 
+                        '_measure_luminance', 
+                        lambda *a, **k: constants.MINIMUM_DAYLIGHT_LUMINANCE)
+    monkeypatch.setattr(webcam.camera.Camera,
+                        '_compute_target_luminance',
+                        lambda *a, **k: constants.MINIMUM_DAYLIGHT_LUMINANCE)
+
+    camera._low_light_search(constants.MINIMUM_DAYLIGHT_LUMINANCE - 10)
+    assert camera._prepare_camera_object.call_count == 1
+    assert len(logs) == 8
+    assert "Low light detected" in logs[0]
+    assert "Trying to get a brighter image" in logs[1]
+    assert "Camera warm-up" in logs[2]
+    assert "OK! Luminance achieved" in logs[3]
+    assert "Taking AWB stabilized picture with the final parameters" in logs[4]
+    assert "Adjusting white balance" in logs[5]
+    assert "Taking picture" in logs[6]
+    assert "Picture taken" in logs[7]
+    assert os.path.exists(tmpdir / "temp_photo.jpg")
 
 
 def test_low_light_search_initial_picture_very_dark(monkeypatch, tmpdir, logs):
@@ -253,7 +294,7 @@ def test_low_light_search_initial_picture_very_dark(monkeypatch, tmpdir, logs):
                         lambda *a, **k: None)
 
     monkeypatch.setattr(webcam.camera.Camera, 
-                        '_luminance_from_path', 
+                        '_measure_luminance', 
                         lambda *a, **k: constants.MINIMUM_DAYLIGHT_LUMINANCE)
 
     monkeypatch.setattr(webcam.camera.Camera,
@@ -278,7 +319,7 @@ def test_low_light_search_one_attempt_returns_a_black_frame(monkeypatch, tmpdir,
                         lambda *a, **k: None)
 
     monkeypatch.setattr(webcam.camera.Camera, 
-                        '_luminance_from_path', 
+                        '_measure_luminance', 
                         mock.Mock(side_effect=[
                             0.0,
                             constants.MINIMUM_DAYLIGHT_LUMINANCE,
@@ -306,7 +347,7 @@ def test_low_light_attempts_are_limited(monkeypatch, tmpdir, logs):
                         lambda *a, **k: None)
 
     monkeypatch.setattr(webcam.camera.Camera, 
-                        '_luminance_from_path', 
+                        '_measure_luminance', 
                         lambda *a, **k: constants.MINIMUM_DAYLIGHT_LUMINANCE - 10)
 
     monkeypatch.setattr(webcam.camera.Camera,
@@ -331,7 +372,7 @@ def test_low_light_shutter_speed_and_ISO_are_limited(monkeypatch, tmpdir, logs):
                         lambda *a, **k: None)
 
     monkeypatch.setattr(webcam.camera.Camera, 
-                        '_luminance_from_path', 
+                        '_measure_luminance', 
                         lambda *a, **k: constants.MINIMUM_DAYLIGHT_LUMINANCE - 10)
 
     # This makes _low_light_equation return a crazy high number
@@ -352,6 +393,26 @@ def test_low_light_shutter_speed_and_ISO_are_limited(monkeypatch, tmpdir, logs):
     assert "ISO is at 800 and shutter speed is at max" in logs[9]
     
 
+def test_low_light_equation_linear(logs):
+    camera = Camera({'image': {}})
+    assert camera._low_light_equation(1000, 10, 20) == 2000
+    assert len(logs) == 0
+
+
+def test_low_light_equation_fitted_on_previous_probe(logs):
+    camera = Camera({'image': {}})
+    # Luminance grows with the square root of the shutter speed
+    assert camera._low_light_equation(4000, 20, 40, (1000, 10)) == 16000
+    assert len(logs) == 0
+
+
+def test_low_light_equation_unreliable_fit_is_ignored(logs):
+    camera = Camera({'image': {}})
+    # The luminance didn't change at all: assume a linear response
+    assert camera._low_light_equation(4000, 10, 20, (1000, 10)) == 8000
+    assert len(logs) == 0
+
+
 def test_compute_target_luminance_daylight(logs):
     camera = Camera({'image': {}})
     lum = constants.MINIMUM_DAYLIGHT_LUMINANCE + 10
@@ -397,6 +458,14 @@ def test_luminance_from_path_black_pic(tmpdir, logs):
     assert len(logs) == 0
 
 
+def test_luminance_from_path_large_pic(tmpdir, logs):
+    camera = Camera({'image': {}})
+    image = Image.new("RGB", (2000, 1500), color="#808080")
+    image.save(str(tmpdir / 'pic.jpg'), format="JPEG")
+    assert abs(camera._luminance_from_path(tmpdir / 'pic.jpg') - 128) < 1
+    assert len(logs) == 0
+
+
 def test_process_picture_cant_open_picture(tmpdir, logs):
     camera = Camera({'image': {}})
     camera.temp_photo_path = tmpdir / "temp_photo.jpg"
@@ -504,6 +573,28 @@ def test_process_picture_overlay_fails(monkeypatch, tmpdir, logs):
     assert not ImageChops.difference(temp_img, proc_img).getbbox()
 
 
+def test_process_picture_invalid_date_format(tmpdir, logs):
+    camera = Camera({'image': {'date_format': 1}, 'overlays': {
+        'top_right': {
+            'type': 'text',
+            'text': '%%DATE',
+        }
+    }})
+    camera.temp_photo_path = tmpdir / "temp_photo.jpg"
+    image = Image.new("RGB", (1000, 1000), color="#000000")
+    image.save(str(camera.temp_photo_path))
+
+    camera._process_picture()
+
+    assert len(logs) == 2
+    assert "The date format 1 is invalid" in logs[0]
+    assert "Creating overlay" in logs[1]
+    assert os.path.exists(camera.processed_image_path)
+    temp_img = Image.open(str(camera.temp_photo_path))
+    proc_img = Image.open(str(camera.processed_image_path))
+    assert temp_img.height < proc_img.height
+
+
 def test_process_overlay_of_wrong_position(monkeypatch, tmpdir, logs):
     camera = Camera({'image': {}, 'overlays': {'test': {}}})
     camera.temp_photo_path = tmpdir / "temp_photo.jpg"
@@ -595,6 +686,61 @@ def test_process_picture_overlay_into_picture(tmpdir, logs):
     assert temp_img.height == proc_img.height
 
 
+def test_process_picture_opaque_overlay_into_picture(tmpdir, logs):
+    camera = Camera({'image': {'extension': 'png'}, 'overlays': {
+        'top_left': {
+            'type': 'image',
+            'path': tmpdir / 'overlay.png',
+            'over_the_picture': True,
+            'padding': 0
+        }
+    }})
+    camera.temp_photo_path = tmpdir / "temp_photo.jpg"
+    image = Image.new("RGB", (10, 10), color="#000000")
+    image.save(str(camera.temp_photo_path))
+
+    overlay_image = Image.new("RGBA", (5, 5), color="#FFFFFFFF")
+    overlay_image.save(str(tmpdir / 'overlay.png'))
+
+    camera._process_picture()
+
+    assert len(logs) == 1
+    assert "Creating overlay" in logs[0]
+    proc_img = Image.open(str(camera.processed_image_path))
+    # Nothing transparent to keep: no need for the alpha channel
+    assert proc_img.mode == "RGB"
+    assert proc_img.getpixel((0, 0)) == (255, 255, 255)
+    assert proc_img.getpixel((5, 5)) == (0, 0, 0)
+
+
+def test_process_picture_transparent_border_save_in_png(tmpdir, logs):
+    camera = Camera({'image': {'extension': 'png'}, 'overlays': {
+        'top_left': {
+            'type': 'image',
+            'path': tmpdir / 'overlay.png',
+            'over_the_picture': False,
+            'padding': 0
+        }
+    }})
+    camera.temp_photo_path = tmpdir / "temp_photo.jpg"
+    image = Image.new("RGB", (10, 10), color="#000000")
+    image.save(str(camera.temp_photo_path))
+
+    overlay_image = Image.new("RGBA", (5, 5), color="#FFFFFFFF")
+    overlay_image.save(str(tmpdir / 'overlay.png'))
+
+    camera._process_picture()
+
+    assert len(logs) == 1
+    assert "Creating overlay" in logs[0]
+    proc_img = Image.open(str(camera.processed_image_path))
+    # The default background is transparent and shows on the right of the overlay
+    assert proc_img.mode == "RGBA"
+    assert proc_img.getpixel((0, 0)) == (255, 255, 255, 255)
+    assert proc_img.getpixel((9, 0)) == (0, 0, 0, 0)
+    assert proc_img.getpixel((0, 5)) == (0, 0, 0, 255)
+
+
 def test_process_text_overlay_into_picture(tmpdir, logs):
     camera = Camera({'image': {}, 'overlays': {
         'top_right': {
@@ -0,0 +1 @@
+from tests.mocks.server import overlay_png_bytes, mock_ftplib, mock_requests
@@ -8,7 +8,7 @@ import zanzocam.constants as constants
 from zanzocam.webcam.errors import ServerError
 from zanzocam.webcam.server.http_server import HttpServer
 
-from tests.conftest import MockGetRequest, MockPostRequest
+from tests.mocks.server import MockGetRequest, MockPostRequest
 
 
 @pytest.fixture(autouse=True)
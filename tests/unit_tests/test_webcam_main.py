@@ -165,9 +165,32 @@ def test_main_error_taking_picture(mock_modules_apart_config, monkeypatch, logs)
     assert len(logs) > 0
     assert not in_logs(logs, "old_test_config")
     assert in_logs(logs, "new_test_config")
+    assert in_logs(logs, "An exception occurred! Retrying won't help.")
+    assert not in_logs(logs, "retrying")
+    assert not in_logs(logs, "Restoring the old configuration")
+    assert in_logs(logs, "Execution completed with errors")
+
+
+def test_main_transient_error_taking_picture(mock_modules_apart_config, monkeypatch, logs):
+    with open(str(constants.CONFIGURATION_FILE), 'w') as c:
+        c.write('{"server": {"old-test-config": "present"}}')
+
+    def camera_busy(*a, **k):
+        raise OSError("camera busy")
+
+    waits = []
+    monkeypatch.setattr(webcam.main, "sleep", lambda seconds: waits.append(seconds))
+    monkeypatch.setattr(
+        webcam.main.Camera, 
+        "take_picture", 
+        camera_busy
+    )
+    main()
+    assert len(logs) > 0
     assert in_logs(logs, "An exception occurred!")
     assert in_logs(logs, "retrying")
-    assert not in_logs(logs, "Restoring the old configuration")
+    assert waits == [1, 2]
+    assert not in_logs(logs, "uploading picture")
     assert in_logs(logs, "Execution completed with errors")
 
 
@@ -194,6 +217,30 @@ def test_main_error_uploading_picture(mock_modules_apart_config, monkeypatch, lo
     assert in_logs(logs, "Execution completed with errors")
 
 
+def test_main_server_error_uploading_picture(mock_modules_apart_config, monkeypatch, logs):
+    with open(str(constants.CONFIGURATION_FILE), 'w') as c:
+        c.write('{"server": {"old-test-config": "present"}}')
+
+    def raise_servererror(*a, **k):
+        raise ServerError('test error')
+
+    monkeypatch.setattr(
+        webcam.main.Server, 
+        'upload_picture',
+        raise_servererror
+    )
+    main()
+    assert len(logs) > 0
+    assert in_logs(logs, "An error occurred communicating with the server")
+    assert in_logs(logs, "Restoring the old configuration file")
+    # The server that failed is not reused for the logs
+    logs = list(logs)
+    logs_upload = logs.index("Uploading the logs...")
+    assert "[TEST] init Server - mocked" in logs[logs_upload:]
+    assert in_logs(logs, "[TEST] uploading logs - mocked")
+    assert in_logs(logs, "Execution completed with errors")
+
+
 def test_main_fail_cleanup_image_files(mock_modules_apart_config, monkeypatch, logs):
     with open(str(constants.CONFIGURATION_FILE), 'w') as c:
         c.write('{"server": {"old-test-config": "present"}}')
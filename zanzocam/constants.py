@@ -127,6 +127,14 @@ MAX_SHUTTER_SPEED = int(9.5 * 10**6)
 #: How much tolerance to give to the low light search algorithm
 TARGET_LUMINOSITY_MARGIN = 3
 
+#: Range of the fitted camera response (luminance ~ shutter_speed^exponent)
+#:  that the low light search trusts: outside of it, it assumes a linear response
+LOW_LIGHT_RESPONSE_EXPONENT_RANGE = (0.2, 1.5)
+
+#: Size of the raw frames used by the low light search algorithm
+#:  to measure the luminance (must be a multiple of 32x16)
+LUMINANCE_PROBE_RESOLUTION = (320, 240)
+
 #: Time to allow the firmware to compute the right exposure in normal
 #:  light conditions (AWB requires more)
 CAMERA_WARM_UP_TIME = 5
@@ -176,6 +184,7 @@ OVERLAY_DEFAULTS = {
     "background_color": (255, 255, 255, 0),
     "image": None,
     "width": None,   # Might be unset to retain aspect ratio
-    "heigth": None,  # Might be unset to retain aspect ratio
+    "height": None,  # Might be unset to retain aspect ratio
+    "path": None,
     "over_the_picture": False,
 }
@@ -141,29 +141,30 @@ def delete_all_logs_endpoint():
 # Error handlers
 #
 
-@app.errorhandler(400)
-def handle_bad_request(e):
-    return render_template("error.html", title="400", message="400 - Bad Request"), 400
-
-@app.errorhandler(401)
-def handle_unauthorized(e):
-    return render_template("error.html", title="401", message="401 - Unauthorized"), 401
-
-@app.errorhandler(403)
-def handle_forbidden(e):
-    return render_template("error.html", title="403", message="403 - Forbidden"), 403
-
-@app.errorhandler(404)
-def handle_not_found(e):
-    return render_template("error.html", title="404", message="404 - Not Found"), 404
-
-@app.errorhandler(405)
-def handle_method_not_allowed(e):
-    return render_template("error.html", title="405", message="405 - Method Not Allowed"), 405
-
-@app.errorhandler(500)
-def handle_internal_error(e):
-    return render_template("error.html", title="500", message="500 - Internal Server Error"), 500
+#: Error codes with a custom error page, and their message
+ERROR_MESSAGES = {
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+#: The error pages are static: each of them is rendered only once
+_rendered_errors = {}
+
+def handle_error(e):
+    code = getattr(e, "code", 500)
+    if code not in ERROR_MESSAGES:
+        code = 500
+    if code not in _rendered_errors:
+        _rendered_errors[code] = render_template(
+            "error.html", title=str(code), message=f"{code} - {ERROR_MESSAGES[code]}")
+    return _rendered_errors[code], code
+
+for code in ERROR_MESSAGES:
+    app.register_error_handler(code, handle_error)
 
 
 #
@@ -3,31 +3,74 @@ from typing import Any, Dict, Tuple, Optional
 import os
 import math
 import piexif
+import datetime
+from operator import mul
 from time import sleep
 from pathlib import Path
 from fractions import Fraction
-from PIL import Image, ImageStat
+from PIL import Image, ImageColor
 
 try:
     from picamera import PiCamera
+    from picamera.exc import PiCameraMMALError
 except ImportError:  # On the CI picamera is not installed
     from tests.conftest import MockPiCamera as PiCamera
+    from tests.conftest import MockPiCameraMMALError as PiCameraMMALError
 
 from zanzocam.constants import *
 from zanzocam.webcam.utils import log, log_error
 from zanzocam.webcam.overlays import Overlay
 
 
+#: Camera errors that might go away by trying again later,
+#:  like the camera being busy with another process
+TRANSIENT_CAMERA_ERRORS = (OSError, PiCameraMMALError)
+
+#: The values a channel of an 8 bit picture can take
+_CHANNEL_LEVELS = range(256)
+
+
+def luminance_from_rgb(r: float, g: float, b: float) -> float:
+    """
+    Given the mean of the RGB channels, returns the perceived luminance.
+    """
+    return math.sqrt(0.241*r*r + 0.691*g*g + 0.068*b*b)
+
+
+def luminance_from_picture(photo: Image.Image) -> float:
+    """
+    Given an image, returns its perceived luminance, computed 
+    from the mean of each of its RGB channels.
+    The pixels are walked only once, by PIL, to build the histogram:
+    the means are then computed from the 256 levels of each channel.
+    """
+    if photo.mode != "RGB":
+        photo = photo.convert("RGB")
+    histogram = photo.histogram()
+    pixels = photo.width * photo.height
+    r, g, b = (sum(map(mul, _CHANNEL_LEVELS, histogram[start:start+256])) / pixels
+               for start in (0, 256, 512))
+    return luminance_from_rgb(r, g, b)
+
+
+def _is_opaque(color: Any) -> bool:
+    """
+    Whether a color, given either as a tuple or as a string, has no transparency.
+    """
+    if isinstance(color, str):
+        color = ImageColor.getcolor(color, "RGBA")
+    return len(color) < 4 or color[3] == 255
+
 
 class Camera:
     """
     Manages the pictures taking process.
     """
+    #: Fallback values for all the expected fields of 'image'
+    defaults = CAMERA_DEFAULTS
+
     def __init__(self, camera_data: Dict[str, Any] = None):
 
-        # Provide defaults for all the expected values of 'image'
-        self.defaults = CAMERA_DEFAULTS
-        
         # Populate the attributes with the 'image' data 
         if not isinstance(camera_data, dict):
             log("WARNING! Image information must be a dictionary! "
@@ -40,25 +83,42 @@ class Camera:
                 "Please fix the error ASAP. Fallback values are being used.")
             camera_data['image'] = CAMERA_DEFAULTS
 
-        for key, value in camera_data['image'].items():
+        # Every expected field becomes an attribute, set to its fallback value if not given
+        for key, value in {**self.defaults, **camera_data['image']}.items():
             setattr(self, key, value)
         
         self.overlays = {}
         if 'overlays' in camera_data.keys():
             self.overlays = camera_data['overlays']
 
+        # Resolution to shoot at, known once the camera is opened the first time
+        self._resolution = None
+
         # Image name
         self.temp_photo_path = DATA_PATH / ('.temp_image.' + self.extension)
         self.processed_image_path = DATA_PATH / ('.final_image.' + self.extension)
 
 
-    def __getattr__(self, name):
-        """ 
-        Provide some fallback value for all the expected fields of 'image'.
-        Logs the access to highlight values that are not set, but were used.
-        """
-        return self.defaults.get(name, None)
-        
+    @property
+    def temp_photo_path(self) -> Path:
+        return self._temp_photo_path
+
+    @temp_photo_path.setter
+    def temp_photo_path(self, path: Path) -> None:
+        # Keep the string version around too: PIL and picamera want strings
+        self._temp_photo_path = path
+        self._temp_photo_str = str(path)
+
+
+    @property
+    def processed_image_path(self) -> Path:
+        return self._processed_image_path
+
+    @processed_image_path.setter
+    def processed_image_path(self, path: Path) -> None:
+        self._processed_image_path = path
+        self._processed_image_str = str(path)
+
 
     def take_picture(self) -> None:
         """
@@ -81,19 +141,10 @@ class Camera:
         else:
             camera = PiCamera(sensor_mode=3)  # sensor_mode 1 has a blue halo on v2!
 
-        if int(self.width) > camera.MAX_RESOLUTION.width:
-            log(f"WARNING! The requested image width ({self.width}) "
-                f"exceeds the maximum width resolution for this camera ({camera.MAX_RESOLUTION.width}). "
-                f"Using the maximum width resolution instead.")
-            self.width = camera.MAX_RESOLUTION.width
-
-        if int(self.height) > camera.MAX_RESOLUTION.height:
-            log(f"WARNING! The requested image height ({self.height}) "
-                f"exceeds the maximum height resolution for this camera ({camera.MAX_RESOLUTION.height}). "
-                f"Using the maximum height resolution instead.")
-            self.height = camera.MAX_RESOLUTION.height
-
-        camera.resolution = (int(self.width), int(self.height))
+        # The sensor doesn't change between shots: check the resolution only once
+        if not self._resolution:
+            self._resolution = self._fit_resolution(camera.MAX_RESOLUTION)
+        camera.resolution = self._resolution
         camera.vflip = self.ver_flip
         camera.hflip = self.hor_flip
         camera.rotation = int(self.rotation)
@@ -101,18 +152,50 @@ class Camera:
             camera.awb_mode = self.awb_mode
         return camera
 
+    def _fit_resolution(self, max_resolution) -> Tuple[int, int]:
+        """
+        Returns the requested resolution, capped to the maximum resolution of the camera.
+        """
+        width, height = int(self.width), int(self.height)
+
+        if width > max_resolution.width:
+            log(f"WARNING! The requested image width ({self.width}) "
+                f"exceeds the maximum width resolution for this camera ({max_resolution.width}). "
+                f"Using the maximum width resolution instead.")
+            width = max_resolution.width
+
+        if height > max_resolution.height:
+            log(f"WARNING! The requested image height ({self.height}) "
+                f"exceeds the maximum height resolution for this camera ({max_resolution.height}). "
+                f"Using the maximum height resolution instead.")
+            height = max_resolution.height
+
+        return width, height
+
     def _camera_capture(self, camera):
         """
         Takes a picture and saves it in the temporary picture path,
         taking care of the logging too.
         """
         log("Taking picture...")
-        camera.capture(str(self.temp_photo_path))
+        camera.capture(self._temp_photo_str)
         exposure_speed = f"{camera.exposure_speed/10**6:.4f}" if camera.exposure_speed else '[auto]'
         shutter_speed = f"{camera.shutter_speed/10**6:.4f}" if camera.shutter_speed else '[auto]'
         iso = camera.iso if camera.iso else '[auto]'
         log(f"Picture taken (exposure speed: {exposure_speed}, "
             f"shutter speed: {shutter_speed}, iso: {iso}).")
+
+
+    def _measure_luminance(self, camera, frame_buffer: bytearray) -> float:
+        """
+        Takes a small raw frame into the given buffer and returns its luminance.
+        The frame is kept in memory: no JPEG is encoded, saved or decoded.
+        The buffer must hold LUMINANCE_PROBE_RESOLUTION RGB pixels and can
+        be reused across calls.
+        """
+        camera.capture(frame_buffer, format="rgb", resize=LUMINANCE_PROBE_RESOLUTION)
+        frame = Image.frombuffer("RGB", LUMINANCE_PROBE_RESOLUTION, frame_buffer, "raw", "RGB", 0, 1)
+        return luminance_from_picture(frame)
             
 
     def _shoot_picture(self) -> None:
@@ -133,43 +216,26 @@ class Camera:
             return
 
         # Test the luminance: if the picture is bright enough, return
-        initial_luminance = self._luminance_from_path(self.temp_photo_path)
+        initial_luminance = self._luminance_from_path(self._temp_photo_str)
         if initial_luminance >= MINIMUM_DAYLIGHT_LUMINANCE:
             log(f"Daylight luminance detected: {initial_luminance:.2f} "
                 f"(lower bound is {MINIMUM_DAYLIGHT_LUMINANCE}).")
             return
 
         # We're in low light conditions and allowed to try correcting it.
-        # Calculate new shutter speed with the low light algorithm
-        new_luminance, shutter_speed, iso, attempts = self._low_light_search(initial_luminance)
+        # Calculate new shutter speed with the low light algorithm and shoot again
+        self._low_light_search(initial_luminance)
 
-        # If we're good without one final picture with the long wait for the AWB, return here
-        if not self.let_awb_settle_in_dark:
-            log(f"AWB adjusted picture not required")
-            return
-
-        # Once the correct shutter speed has been found, shoot again a picture with the correct params.
-        log(f"Taking AWB stabilized picture with the final parameters "
-            f"(shutter speed: {shutter_speed/10**6:.2f}s, ISO: {iso})")
-
-        with self._prepare_camera_object(expanded_framerate_range=True) as camera:
-            camera.shutter_speed = shutter_speed
-            camera.iso = iso
-            
-            timeout = (shutter_speed/10**6) * 7 + 5
-            log(f"Adjusting white balance: will take {timeout:.1f} seconds...")
-            sleep(timeout)
-            camera.exposure_mode = "off"
-
-            self._camera_capture(camera)
-
-        final_luminance = self._luminance_from_path(str(self.temp_photo_path))
-        log(f"Final luminance: {final_luminance:.2f}.")
+        # If the white balance was let settle, check how it went
+        if self.let_awb_settle_in_dark:
+            final_luminance = self._luminance_from_path(self._temp_photo_str)
+            log(f"Final luminance: {final_luminance:.2f}.")
 
 
     def _low_light_search(self, initial_luminance: int) -> Tuple[float, int, int, int]:
         """
-        Tries to find the correct shutter speed in low-light conditions.
+        Tries to find the correct shutter speed in low-light conditions,
+        measuring the luminance on small raw frames.
         Returns the final luminance, the shutter speed, and the number of attempts done, in this order.
         """
         target_luminance = self._compute_target_luminance(initial_luminance)        
@@ -193,6 +259,11 @@ class Camera:
             shutter_speed = MIN_SHUTTER_SPEED
     
         new_luminance = initial_luminance
+        previous_probe = None
+
+        # All the probe frames are captured into the same buffer
+        probe_width, probe_height = LUMINANCE_PROBE_RESOLUTION
+        frame_buffer = bytearray(probe_width * probe_height * 3)
 
         # Note that we're looping within this block for a reason!
         # Re-initializing the camera for every picture would take a lot of
@@ -205,26 +276,29 @@ class Camera:
 
             for attempt in range(1, 10):
                 
-                # Take the picture & check the luminance
+                # Take a probe frame & check the luminance
                 camera.shutter_speed = shutter_speed          
                 camera.exposure_mode = "off"
-                self._camera_capture(camera)
-                new_luminance = self._luminance_from_path(self.temp_photo_path)
+                probe_iso = camera.iso
+                new_luminance = self._measure_luminance(camera, frame_buffer)
+
+                # The probes are not saved: the logs are the only record of their parameters
+                probe_params = f"(shutter speed: {shutter_speed/10**6:.2f}s, ISO: {probe_iso})"
 
                 # In rare cases, the camera might return pitch black images for no good reason.
                 # So if the luminance is 0, just retry.
                 if new_luminance <= 0.001:  # Should not be needed, but with floats you never know
                     log(f"# {attempt}: The camera shot a fully black picture "
-                        f"(luminance = {new_luminance:.2f}). Trying again.")
+                        f"(luminance = {new_luminance:.2f}) {probe_params}. Trying again.")
                     continue
 
                 # Too bright: log and retry without further checks
                 elif new_luminance > (target_luminance + TARGET_LUMINOSITY_MARGIN):
-                    log(f"# {attempt}: bright. Luminance achieved: {new_luminance:.2f}. Down!")
+                    log(f"# {attempt}: bright. Luminance achieved: {new_luminance:.2f} {probe_params}. Down!")
                 
                 # Too dark: log and check if you can proceed, raising ISO if so required
                 elif new_luminance < (target_luminance - TARGET_LUMINOSITY_MARGIN):
-                    log(f"# {attempt}: dark. Luminance achieved: {new_luminance:.2f}. Up!")
+                    log(f"# {attempt}: dark. Luminance achieved: {new_luminance:.2f} {probe_params}. Up!")
                     
                     # If the max shutter speed and max ISO is already reached, break: 
                     # you can't reach the target luminance
@@ -232,39 +306,82 @@ class Camera:
                         if camera.iso >= 800:
                             log(f"WARNING! ISO is at 800 and shutter speed is at max "
                                 f"({MAX_SHUTTER_SPEED/10**6:.2f}). Cannot increase further.")
-                            return new_luminance, shutter_speed, camera.iso, attempt
+                            break
 
                         log(f"Not allowed to raise the shutter speed further. "
                             f"Increasing ISO from {camera.iso} to {camera.iso*2} "
                             f"and trying again.")
                         camera.iso = camera.iso*2
 
-                # Otherwise return the match
+                # Otherwise stop at the match
                 else:
-                    log(f"# {attempt}: OK! Luminance achieved: {new_luminance:.2f}.")
-                    return new_luminance, shutter_speed, camera.iso, attempt
+                    log(f"# {attempt}: OK! Luminance achieved: {new_luminance:.2f} {probe_params}.")
+                    break
 
                 # Compute the shutter speed and loop
-                shutter_speed = self._low_light_equation(shutter_speed, new_luminance, target_luminance)
+                next_shutter_speed = self._low_light_equation(
+                    shutter_speed, new_luminance, target_luminance, previous_probe)
+                # A probe taken before raising the ISO says nothing about the new response
+                previous_probe = (shutter_speed, new_luminance) if camera.iso == probe_iso else None
+                shutter_speed = next_shutter_speed
+
+            else:
+                # Exit condition - 10 iterations
+                log_error(f"The low light algorithm failed! "
+                          f"Returning the last values "
+                          f"(shutter speed: {shutter_speed}, "
+                          f"luminance: {new_luminance}, iso: {camera.iso}).")
+
+            # The probes are not saved: shoot the picture with the final values,
+            # on the same camera, letting the white balance settle if so required
+            camera.shutter_speed = shutter_speed
+            if self.let_awb_settle_in_dark:
+                self._settle_white_balance(camera, shutter_speed)
+            self._camera_capture(camera)
 
-            # Exit condition - 10 iterations      
-            log_error(f"The low light algorithm failed! "
-                      f"Returning the last values "
-                      f"(shutter speed: {shutter_speed}, "
-                      f"luminance: {new_luminance}, iso: {camera.iso}).")
             return new_luminance, shutter_speed, camera.iso, attempt
         
+    def _settle_white_balance(self, camera, shutter_speed: int) -> None:
+        """
+        Waits for the white balance to settle on the given shutter speed,
+        then locks the exposure. The gains float again while the exposure
+        is on auto, so they get the full warm-up time to converge.
+        """
+        log(f"Taking AWB stabilized picture with the final parameters "
+            f"(shutter speed: {shutter_speed/10**6:.2f}s, ISO: {camera.iso})")
+        camera.exposure_mode = "auto"
+        timeout = (shutter_speed/10**6) * 7 + CAMERA_WARM_UP_TIME
+        log(f"Adjusting white balance: will take {timeout:.1f} seconds...")
+        sleep(timeout)
+        camera.exposure_mode = "off"
+
+
     @staticmethod
-    def _low_light_equation(shutter_speed, initial_luminance, target_luminance) -> int:
+    def _low_light_equation(shutter_speed, initial_luminance, target_luminance, 
+                            previous_probe: Optional[Tuple[int, float]] = None) -> int:
         """
         Given a starting luminance, computes the best estimate of 
         the shutter speed needed to achieve the target luminance.
+        If the shutter speed and luminance of a previous probe are given,
+        the response of the camera (luminance ~ shutter_speed^exponent) is 
+        fitted on the two probes, otherwise it's assumed to be linear.
         """
         # There should be a check in _low_light_search,
         # but let's make real sure that no zero division errors occur.
         if not initial_luminance:
             initial_luminance = 0.001  
-        target_shutter_speed = (shutter_speed / initial_luminance) * target_luminance
+
+        exponent = 1
+        if previous_probe:
+            previous_shutter_speed, previous_luminance = previous_probe
+            if previous_shutter_speed != shutter_speed and previous_luminance > 0.001:
+                fitted_exponent = (math.log(initial_luminance / previous_luminance) / 
+                                   math.log(shutter_speed / previous_shutter_speed))
+                min_exponent, max_exponent = LOW_LIGHT_RESPONSE_EXPONENT_RANGE
+                if min_exponent <= fitted_exponent <= max_exponent:
+                    exponent = fitted_exponent
+
+        target_shutter_speed = shutter_speed * (target_luminance / initial_luminance) ** (1 / exponent)
 
         if target_shutter_speed > MAX_SHUTTER_SPEED:
             log(f"Max shutter speed has been reached, "
@@ -277,11 +394,13 @@ class Camera:
     @staticmethod
     def _luminance_from_path(path: Path) -> int:
         """
-        Given a path to an image, returns its luminance
+        Given a path to an image, returns its luminance.
+        JPEGs are decoded directly at a reduced scale: the mean 
+        of the channels doesn't need the full resolution.
         """
-        photo = Image.open(str(path))
-        r, g, b = ImageStat.Stat(photo).mean
-        return math.sqrt(0.241*(r**2) + 0.691*(g**2) + 0.068*(b**2))
+        with Image.open(str(path)) as photo:
+            photo.draft("RGB", LUMINANCE_PROBE_RESOLUTION)
+            return luminance_from_picture(photo)
 
 
     @staticmethod
@@ -303,14 +422,31 @@ class Camera:
         """ 
         Renders text and images over the picture and saves the resulting image.
         """
-        # Open and measures the picture
+        # Open and measures the picture. It's converted to the mode
+        # of the canvas only when pasted, once that's known
         try:
-            photo = Image.open(str(self.temp_photo_path)).convert("RGBA")
+            photo = Image.open(self._temp_photo_str)
+            photo.load()
         except Exception as e:
             log_error("Failed to open the image for editing. "
                       "The photo will have no overlays applied.", e)
             return
 
+        # Date and time are the same on all the overlays
+        now = datetime.datetime.now()
+        try:
+            date_string = now.strftime(self.date_format if self.date_format else CAMERA_DEFAULTS["date_format"])
+        except Exception as e:
+            log_error(f"The date format {self.date_format} is invalid. "
+                      f"The default one will be used.", e)
+            date_string = now.strftime(CAMERA_DEFAULTS["date_format"])
+        try:
+            time_string = now.strftime(self.time_format if self.time_format else CAMERA_DEFAULTS["time_format"])
+        except Exception as e:
+            log_error(f"The time format {self.time_format} is invalid. "
+                      f"The default one will be used.", e)
+            time_string = now.strftime(CAMERA_DEFAULTS["time_format"])
+
         # Create the overlay images
         rendered_overlays = []
         for position, data in self.overlays.items():
@@ -318,8 +454,8 @@ class Camera:
                 overlay = Overlay(position, data, 
                                   photo.width, 
                                   photo.height, 
-                                  self.date_format, 
-                                  self.time_format)
+                                  date_string, 
+                                  time_string)
                 if overlay.rendered_image:
                     rendered_overlays.append(overlay)
                     
@@ -327,45 +463,52 @@ class Camera:
                 log_error(f"Something happened processing the overlay {position}. "
                           f"This overlay will be skipped.", e)
 
-        # Calculate final image size
-        border_top = 0
-        border_bottom = 0
-        for overlay in rendered_overlays:                        
-            # If this overlay is out of the picture, add its height to the 
-            # final image size (above or below)
-            if not overlay.over_the_picture:
-                if overlay.vertical_position == "top":
-                    border_top = max(border_top, overlay.rendered_image.height)
-                else:
-                    border_bottom = max(border_bottom, overlay.rendered_image.height)
+        # Calculate final image size: the overlays out of the picture 
+        # add their height to it (above or below)
+        outer_overlays = [(overlay.is_top, overlay.rendered_image.height)
+                          for overlay in rendered_overlays if not overlay.over_the_picture]
+        border_top = max((height for is_top, height in outer_overlays if is_top), default=0)
+        border_bottom = max((height for is_top, height in outer_overlays if not is_top), default=0)
         total_height = photo.height + border_top + border_bottom
 
+        # The canvas needs an alpha channel only if some transparency can show up
+        # in the final image: never in JPEGs, and in the other formats only 
+        # with a transparent background around the picture or transparent overlays.
+        # Otherwise compose in RGB, rather than converting a whole RGBA image
+        is_jpeg = self.extension.lower() in ["jpg", "jpeg"]
+        has_transparency = (
+            ((border_top or border_bottom) and not _is_opaque(self.background_color)) or
+            any(overlay.mask for overlay in rendered_overlays))
+        canvas_mode = "RGBA" if has_transparency and not is_jpeg else "RGB"
+
         # Generate canvas of the correct size
-        image = Image.new("RGBA", 
+        image = Image.new(canvas_mode, 
                           (photo.width, total_height),
                           color=self.background_color)
 
         # Add the picture on the canvas
         image.paste(photo, (0, border_top))
 
+        # Compute where the overlays go, now that the canvas size is known
+        positions = [overlay.compute_position(image.width, image.height, border_top, border_bottom)
+                     for overlay in rendered_overlays]
+
         # Add the overlays on the canvas in the right position
-        for overlay in rendered_overlays:
-            if overlay.rendered_image:  # it might be None if it failed along the way
-                x, y = overlay.compute_position(image.width, image.height, border_top, border_bottom)
-                if x + overlay.rendered_image.width > image.width:
-                    log("WARNING! This overlay exceeds the margin of the image itself "
-                        "on the right. It might not be fully visible in the final picture.")
-                if x < 0:
-                    log("WARNING! This overlay exceeds the margin of the image itself "
-                        "on the left. It might not be fully visible in the final picture.")
-                if y < 0:
-                    log("WARNING! This overlay exceeds the margin of the image itself "
-                        "at the top. It might not be fully visible in the final picture.")
-                if y + overlay.rendered_image.height > image.height:
-                    log("WARNING! This overlay exceeds the margin of the image itself "
-                        "at the bottom. It might not be fully visible in the final picture.")
-                # mask is to allow for transparent images
-                image.paste(overlay.rendered_image, (x, y), mask=overlay.rendered_image)  
+        for overlay, (x, y) in zip(rendered_overlays, positions):
+            if x + overlay.rendered_image.width > image.width:
+                log("WARNING! This overlay exceeds the margin of the image itself "
+                    "on the right. It might not be fully visible in the final picture.")
+            if x < 0:
+                log("WARNING! This overlay exceeds the margin of the image itself "
+                    "on the left. It might not be fully visible in the final picture.")
+            if y < 0:
+                log("WARNING! This overlay exceeds the margin of the image itself "
+                    "at the top. It might not be fully visible in the final picture.")
+            if y + overlay.rendered_image.height > image.height:
+                log("WARNING! This overlay exceeds the margin of the image itself "
+                    "at the bottom. It might not be fully visible in the final picture.")
+            # mask is to allow for transparent images
+            image.paste(overlay.rendered_image, (x, y), mask=overlay.mask)
 
         # Recover and edit the EXIF data
         exif_bytes = None
@@ -385,13 +528,12 @@ class Camera:
         if exif_bytes:
             save_arguments['exif'] = exif_bytes
 
-        if self.extension.lower() in ["jpg", "jpeg"]:
-            image = image.convert('RGB')
+        if is_jpeg:
             save_arguments['format'] = 'JPEG'
             save_arguments['subsampling'] = self.jpeg_subsampling
             save_arguments['quality'] = self.jpeg_quality
 
-        image.save(self.processed_image_path, **save_arguments)
+        image.save(self._processed_image_str, **save_arguments)
 
 
     def cleanup_image_files(self) -> bool:
@@ -403,11 +545,11 @@ class Camera:
         log("Cleaning up image files.")
 
         try:
-            if os.path.exists(self.temp_photo_path):
-                os.remove(self.temp_photo_path)
+            if os.path.exists(self._temp_photo_str):
+                os.remove(self._temp_photo_str)
 
-            if os.path.exists(self.processed_image_path):
-                os.remove(self.processed_image_path)
+            if os.path.exists(self._processed_image_str):
+                os.remove(self._processed_image_str)
 
         except Exception as e:
             log_error("Failed to clean up image files. Note that the "
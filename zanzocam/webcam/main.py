@@ -18,7 +18,7 @@ from zanzocam.constants import (
 from zanzocam.webcam import system
 from zanzocam.webcam.configuration import load_configuration_from_disk
 from zanzocam.webcam.server import Server
-from zanzocam.webcam.camera import Camera
+from zanzocam.webcam.camera import Camera, TRANSIENT_CAMERA_ERRORS
 from zanzocam.webcam.errors import ServerError
 from zanzocam.webcam.utils import log, log_error, log_row
 from zanzocam.web_ui.utils import read_flag_file
@@ -35,7 +35,8 @@ def main():
         pass
     logging.basicConfig(
         level=logging.INFO,
-        format='%(message)s',
+        format='%(asctime)s -> %(message)s',
+        datefmt='%H:%M:%S',
         handlers=[
             logging.FileHandler(CAMERA_LOG),
             logging.StreamHandler(sys.stdout),
@@ -48,6 +49,7 @@ def main():
     no_errors = True
     config = None
     server = None
+    server_settings = None
     camera = None
 
     try:
@@ -77,7 +79,8 @@ def main():
             no_errors = True
 
         # Create the server
-        server = Server(config.get_server_settings())
+        server_settings = config.get_server_settings()
+        server = Server(server_settings)
 
         # Update the configuration file
         new_config = server.update_configuration(config)
@@ -87,29 +90,43 @@ def main():
             no_errors = system.apply_system_settings(new_config.get_system_settings())
             config = new_config
 
-        log(f"Configuration in use:\n{config}")
+        # Rendering the whole configuration is not cheap: skip it if it won't be logged
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            log(f"Configuration in use:\n{config}")
 
-        # Recreate the server (might differ in the new configuration)
-        server = Server(config.get_server_settings())
+        # Recreate the server, if the new configuration changed its settings
+        new_server_settings = config.get_server_settings()
+        if new_server_settings != server_settings:
+            server = Server(new_server_settings)
+            server_settings = new_server_settings
 
         # Download the overlays
         overlays_list = config.list_overlays()
         no_errors = server.download_overlay_images(overlays_list)
 
         # Take the picture
-        for _ in range(3):
+        for attempt in range(3):
             log("Initializing camera...")
             try:
-                camera = Camera(config.get_camera_settings())
-                camera.take_picture()
+                new_camera = Camera(config.get_camera_settings())
+                new_camera.take_picture()
+                camera = new_camera
                 break
 
-            except Exception as exception:
+            # Errors like a busy camera might go away by waiting a bit
+            except TRANSIENT_CAMERA_ERRORS as exception:
                 no_errors = False
                 log_error("An exception occurred!", exception)
-                log(f"Waiting for {WAIT_AFTER_CAMERA_FAIL} sec. "
-                    "and retrying...")
-                sleep(WAIT_AFTER_CAMERA_FAIL)
+                if attempt < 2:
+                    wait_for = WAIT_AFTER_CAMERA_FAIL * 2**attempt
+                    log(f"Waiting for {wait_for} sec. and retrying...")
+                    sleep(wait_for)
+
+            # Anything else (like bad camera settings) would fail again
+            except Exception as exception:
+                no_errors = False
+                log_error("An exception occurred! Retrying won't help.", exception)
+                break
 
         if not camera:
             no_errors = False
@@ -142,15 +159,22 @@ def main():
             try:
                 config.restore_backup()
                 old_config = load_configuration_from_disk()
-                server_config = json.dumps(old_config.get_server_settings(), indent=4)
-                log(f"The next run will use the following server "
-                    f"configuration:\n{server_config}")
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    server_config = json.dumps(old_config.get_server_settings(), indent=4)
+                    log(f"The next run will use the following server "
+                        f"configuration:\n{server_config}")
 
             except Exception as config_exception:
                 log_error("Failed to restore the backup config. "
                           "ZanzoCam might have no valid config file for the next run.", 
                           config_exception)
 
+        # Neither the configuration in memory (the one on disk might have been
+        # restored) nor the server built from it (it might be the one that just
+        # failed) can be trusted anymore: the logs upload loads and connects again
+        config = None
+        server = None
+
     # This block is called even after a return
     finally:
 
@@ -170,8 +194,10 @@ def main():
         if upload_logs:
             try:
                 log("Uploading the logs...")
-                current_conf = load_configuration_from_disk(quiet=True)
-                server = Server(current_conf.get_server_settings())
+                if not config:
+                    config = load_configuration_from_disk(quiet=True)
+                if server is None or config.get_server_settings() != server_settings:
+                    server = Server(config.get_server_settings())
                 server.upload_logs()
             except Exception as log_exception:
                 log_error("Something went wrong uploading the logs. "
@@ -1,40 +1,93 @@
 from typing import Any, Dict, Tuple, Optional
 
 import math
-import datetime
+from functools import lru_cache
 from PIL import Image, ImageFont, ImageDraw
 
 from zanzocam.constants import *
 from zanzocam.webcam.utils import log, log_error
 
 
+#: How far along the free width of the picture each horizontal position is, in halves
+_HORIZONTAL_ALIGNMENTS = {"left": 0, "center": 1, "right": 2}
+
+
+@lru_cache(maxsize=32)
+def _get_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    Loads a font once for each path and size: parsing the
+    TTF file is expensive and the fonts are never modified.
+    """
+    return ImageFont.truetype(path, size)
+
+
+def _wrap_text(text: str, font: ImageFont.FreeTypeFont, max_line_length: int) -> Tuple[str, int, int]:
+    """ 
+    Inserts as many returns as needed to make the text fit in the given
+    width, and measures it. Returns the wrapped text, its width and its height.
+    """
+    # Insert as many returns as needed to make the text fit.
+    lines = []
+    for line in text.split("\n"):
+        if font.getlength(line) <= max_line_length:
+            lines.append(line)
+            continue
+
+        # Measure each word only once and break the line 
+        # as soon as the running width overflows
+        space_width = font.getlength(" ")
+        new_line = []
+        new_line_width = 0
+        for word in line.split(" "):
+            word_width = font.getlength(word)
+            if new_line and new_line_width + word_width > max_line_length:
+                lines.append(" ".join(new_line))
+                new_line = []
+                new_line_width = 0
+            new_line.append(word)
+            new_line_width += word_width + space_width
+        if new_line:
+            lines.append(" ".join(new_line))
+    wrapped_text = '\n'.join(lines)
+
+    # Measure text's bounding box (no margins applied here)
+    text_width = math.ceil(max(font.getlength(line) for line in lines))
+    # https://stackoverflow.com/questions/43060479/how-to-get-the-font-pixel-height-using-pils-imagefont-class
+    ascent, descent = font.getmetrics()
+    # The text has approximately a 3% interline space
+    text_height = math.ceil(len(lines) * ascent * 1.03) + descent
+    return wrapped_text, text_width, text_height
+
 
 class Overlay:
     """
     Represents one overlay to add to the picture.
     """
-    def __init__(self, position: str, data: Dict, photo_width: int, photo_height: int, date_format: Optional[str], time_format: Optional[str]):
+    #: Fallback values for all the expected fields of 'overlay'
+    defaults = OVERLAY_DEFAULTS
+
+    def __init__(self, position: str, data: Dict, photo_width: int, photo_height: int, date_string: str, time_string: str):
         log(f"Creating overlay {position}.")
         
         # Where the rendered overlay is stored if can be generated
         self.rendered_image = None
-        self.defaults = OVERLAY_DEFAULTS
+        # The mask to paste the overlay with: None if it's fully opaque
+        self.mask = None
         
-        # Populate the attributes with the overlay data 
-        for key, value in data.items():
+        # Populate the attributes with the overlay data, 
+        # setting every expected field to its fallback value if not given
+        for key, value in {**self.defaults, **data}.items():
             setattr(self, key, value)
-        self.date_format = date_format if date_format else "%d %B %Y"
-        self.time_format = time_format if time_format else "%H:%M"
+        self.date_string = date_string
+        self.time_string = time_string
 
         # Store position information
         try:
             self.vertical_position, self.horizontal_position = position.lower().split("_")
-            if ((self.vertical_position != "top" and 
-                 self.vertical_position != "bottom") or
-                (self.horizontal_position != "left" and 
-                 self.horizontal_position != "center" and 
-                 self.horizontal_position != "right")):
+            if self.vertical_position != "top" and self.vertical_position != "bottom":
                 raise ValueError()
+            self.horizontal_alignment = _HORIZONTAL_ALIGNMENTS[self.horizontal_position]
+            self.is_top = self.vertical_position == "top"
  
         except Exception as e:
             log_error(f"The position of this overlay ({position}) is malformed. "
@@ -61,16 +114,9 @@ class Overlay:
             "text, image. This overlay will be skipped.")
             return
 
-
-    def __getattr__(self, name):
-        """ 
-        Provide some fallback value for all the expected fields of 'overlay'.
-        Logs the access to highlight values that are not set, but were used.
-        """
-        if name in self.defaults.keys():
-            #log(f"WARNING: Accessing default value for {name}: {value}")
-            return self.defaults[name]
-        return None
+        # Fully opaque overlays can be copied over the picture without blending
+        if self.rendered_image and self.rendered_image.getextrema()[3] != (255, 255):
+            self.mask = self.rendered_image
 
 
     def compute_position(self, image_width: int, image_height: int, 
@@ -79,29 +125,16 @@ class Overlay:
         Returns the x,y position in the picture where this overlay 
         should be pasted.
         """
-        x, y = 0, 0
-        
-        if self.horizontal_position == "left":
-            x = 0
-            
-        elif self.horizontal_position == "right":
-            x = image_width - self.rendered_image.width
-            
-        elif self.horizontal_position == "center":
-            x = int((image_width - self.rendered_image.width)/2)
+        free_width = image_width - self.rendered_image.width
+        x = int(free_width * self.horizontal_alignment / 2)
 
-        if self.vertical_position == "top":
-            if self.over_the_picture:
-                y = border_top
-            else:
-                y = 0
-                
-        elif self.vertical_position == "bottom":
+        if self.is_top:
+            y = border_top if self.over_the_picture else 0
+        else:
+            y = image_height - self.rendered_image.height
             if self.over_the_picture:
-                y = image_height - self.rendered_image.height - border_bottom
-            else:
-                y = image_height - self.rendered_image.height
-                
+                y -= border_bottom
+
         return x, y
 
 
@@ -113,27 +146,25 @@ class Overlay:
         try:
             # Creates the font and calculate the line height
             font_size = self.font_size
-            font = ImageFont.truetype(FONT_PATH, font_size)
+            font = _get_font(FONT_PATH, font_size)
 
             # Replace %%TIME and %%DATE with respective values
-            time_string = datetime.datetime.now().strftime(self.time_format)
-            date_string = datetime.datetime.now().strftime(self.date_format)
-            self.text = self.text.replace("%%TIME", time_string)
-            self.text = self.text.replace("%%DATE", date_string)
-
-            # Calculate the dimension of the text with the padding added
-            text_width, text_height = self.process_text(font, photo_width)
-            text_size = (text_width + self.padding*2, text_height + self.padding*2)
+            text = self.text.replace("%%TIME", self.time_string)
+            text = text.replace("%%DATE", self.date_string)
 
             # Some very popular browsers use \r\n to save newlines from 
             # textareas: normalize
-            self.text = self.text.replace("\r\n", "\n")
+            text = text.replace("\r\n", "\n")
+
+            # Make the text fit and calculate its dimension with the padding added
+            text, text_width, text_height = _wrap_text(text, font, photo_width)
+            text_size = (text_width + self.padding*2, text_height + self.padding*2)
 
             # Creates the image
             label = Image.new("RGBA", text_size, color=self.background_color)
             draw = ImageDraw.Draw(label)
             draw.text((self.padding, self.padding, self.padding), 
-                      self.text, self.font_color, font=font)
+                      text, self.font_color, font=font)
 
             # Store it
             return label
@@ -144,36 +175,6 @@ class Overlay:
             return
 
 
-    def process_text(self, font: Any, max_line_length: int) -> Tuple[int, int]:
-        """ 
-        Measures and insert returns into the text to make it fit into the image.
-        """
-        # Insert as many returns as needed to make the text fit.
-        lines = []
-        for line in self.text.split("\n"):
-            if font.getsize(line)[0] <= max_line_length:
-                lines.append(line)
-            else:
-                new_line = ""
-                for word in line.split(" "):
-                    if font.getsize(new_line + word)[0] <= max_line_length:
-                        new_line = new_line + word + " "
-                    else:
-                        lines.append(new_line)
-                        new_line = word + " "
-                if new_line != "":
-                    lines.append(new_line)
-        self.text = '\n'.join(lines)
-
-        # Measure text's bounding box (no margins applied here)
-        text_width = max([font.getsize(line)[0] for line in lines])
-        # https://stackoverflow.com/questions/43060479/how-to-get-the-font-pixel-height-using-pils-imagefont-class
-        ascent, descent = font.getmetrics()
-        # The text has approximately a 3% interline space
-        text_height = math.ceil(len(lines) * ascent * 1.03) + descent
-        return text_width, text_height
-
-
     def create_image_overlay(self) -> Any:
         """ 
         Prepares an overlay containing an image.
@@ -1,13 +1,16 @@
 import sys
 import json
 import logging
-import datetime
 import traceback
 from time import sleep
 from pathlib import Path
 from functools import wraps
 
 
+#: The root logger, configured by the entry points
+_LOGGER = logging.getLogger()
+
+
 def retry(times: int, wait_for: float):
     """
     Makes the decorated function try to run without
@@ -51,15 +54,20 @@ class AllStringEncoder(json.JSONEncoder):
 
 def log(msg: str) -> None:
     """ 
-    Logs the message to the console
+    Logs the message to the console.
+    The timestamp is added by the handler (see `main.py`).
     """
-    logging.info(f"{datetime.datetime.now().strftime('%H:%M:%S')} -> {msg}")
+    logging.info(msg)
 
 
 def log_error(msg: str, e: Exception=None, fatal: str=None) -> None:
     """
     Logs an error to the console
     """
+    # Don't format the stacktrace if it's going to be discarded
+    if not _LOGGER.isEnabledFor(logging.INFO):
+        return
+
     if msg and msg != "":
         msg = f"ERROR! {msg} "
     
@@ -74,11 +82,15 @@ def log_error(msg: str, e: Exception=None, fatal: str=None) -> None:
     log(f"{msg}{fatal_msg} {stacktrace}")    
     
 
+#: The default row logged by log_row()
+_ROW = f"\n{'='*50}\n"
+
+
 def log_row(char: str = "=") -> None:
     """ 
     Logs a row to the console
     """
-    logging.info(f"\n{char*50}\n")
+    logging.info(_ROW if char == "=" else f"\n{char*50}\n")
 
 
 #def read_flag_file(path: Path):